@@ -4,13 +4,15 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 import numpy as np
+from scipy.ndimage import distance_transform_cdt, label
 from collections import deque
 from policy import Policy
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 
 class CuttingStockMetrics:
-    def __init__(self):
-        # Episode-level metrics
+    def __init__(self, metric_capacity=100000):
+        # Episode-level metrics; per-placement ones are fixed-size ring buffers
+        self.metric_capacity = metric_capacity
         self.episode_metrics = {
             'filled_ratios': [],
             'waste_ratios': [],
@@ -18,8 +20,8 @@ class CuttingStockMetrics:
             'invalid_actions': [],
             'episode_lengths': [],
             'rewards': [],
-            'edge_utilization': [],
-            'corner_placements': [],
+            'edge_utilization': np.zeros(metric_capacity, dtype=np.int16),
+            'corner_placements': np.zeros(metric_capacity, dtype=np.int16),
             'largest_waste_area': [],
             'product_completion_order': []
         }
@@ -38,18 +40,54 @@ class CuttingStockMetrics:
             'best_episode': -1
         }
         
-        # Running averages
+        # Running averages (fixed-size ring buffers)
+        self.running_window = 10
         self.running_averages = {
-            'filled_ratio': deque(maxlen=10),
-            'waste_ratio': deque(maxlen=10),
-            'reward': deque(maxlen=10)
+            'filled_ratio': np.zeros(self.running_window),
+            'waste_ratio': np.zeros(self.running_window),
+            'reward': np.zeros(self.running_window)
         }
+        self.running_counts = {key: 0 for key in self.running_averages}
+        self.metric_counts = {'edge_utilization': 0, 'corner_placements': 0}
+
+    def add_metric_value(self, key, value):
+        """Push a per-placement metric, overwriting the oldest one when the buffer is full"""
+        self.episode_metrics[key][self.metric_counts[key] % self.metric_capacity] = value
+        self.metric_counts[key] += 1
+
+    def get_metric_values(self, key):
+        """Values currently held in a per-placement metric buffer, oldest first"""
+        count = self.metric_counts[key]
+        values = self.episode_metrics[key]
+        if count <= self.metric_capacity:
+            return values[:count]
+        start = count % self.metric_capacity
+        return np.concatenate((values[start:], values[:start]))
+
+    def add_running_value(self, key, value):
+        """Push a value into the running window, overwriting the oldest one when full"""
+        self.running_averages[key][self.running_counts[key] % self.running_window] = value
+        self.running_counts[key] += 1
+
+    def set_last_running_value(self, key, value):
+        """Overwrite the most recent value of a running window"""
+        if self.running_counts[key] > 0:
+            self.running_averages[key][(self.running_counts[key] - 1) % self.running_window] = value
+
+    def get_running_average(self, key):
+        """Mean over the values currently held in a running window"""
+        count = min(self.running_counts[key], self.running_window)
+        if count == 0:
+            return 0.0
+        return self.running_averages[key][:count].mean()
 
     def add_episode_data(self, episode_number, filled_ratio, total_reward):
         """Record data for a completed episode"""
         self.episode_history['episode_numbers'].append(episode_number)
         self.episode_history['episode_filled_ratios'].append(filled_ratio)
         self.episode_history['episode_rewards'].append(total_reward)
+        self.add_running_value('filled_ratio', filled_ratio)
+        self.add_running_value('reward', total_reward)
         
         # Update best scores
         if filled_ratio > self.best_scores['best_filled_ratio']:
@@ -114,29 +152,64 @@ class CriticNetwork(nn.Module):
         return self.network(state)
 
 class PPOMemory:
-    def __init__(self):
-        self.states = []
-        self.actions = []
-        self.rewards = []
-        self.values = []
-        self.log_probs = []
-        self.dones = []
+    def __init__(self, capacity, device):
+        self.capacity = capacity
+        self.device = device
+        self.idx = 0
+        self.last_added = False  # Whether the most recent add was stored
+        
+        # Buffers are allocated on the first add, once the state size is known
+        self.states = None
+        self.actions = None
+        self.rewards = None
+        self.values = None
+        self.log_probs = None
+        self.dones = None
+        self.valid_actions = None
+    
+    def __len__(self):
+        return self.idx
+    
+    def is_full(self):
+        return self.idx >= self.capacity
+    
+    def _allocate(self, state_dim, action_dim):
+        self.states = torch.empty((self.capacity, state_dim), dtype=torch.float32, device=self.device)
+        self.actions = torch.empty(self.capacity, dtype=torch.int64, device=self.device)
+        self.rewards = torch.empty(self.capacity, dtype=torch.float32, device=self.device)
+        self.values = torch.empty(self.capacity, dtype=torch.float32, device=self.device)
+        self.log_probs = torch.empty(self.capacity, dtype=torch.float32, device=self.device)
+        self.dones = torch.empty(self.capacity, dtype=torch.float32, device=self.device)
+        self.valid_actions = torch.empty((self.capacity, action_dim), dtype=torch.bool, device=self.device)
         
     def clear(self):
-        self.states.clear()
-        self.actions.clear()
-        self.rewards.clear()
-        self.values.clear()
-        self.log_probs.clear()
-        self.dones.clear()
-        
-    def add(self, state, action, reward, value, log_prob, done):
-        self.states.append(state)
-        self.actions.append(action)
-        self.rewards.append(reward)
-        self.values.append(value)
-        self.log_probs.append(log_prob)
-        self.dones.append(done)
+        self.idx = 0
+        self.last_added = False
+        
+    def add(self, state, action, reward, value, log_prob, done, valid_actions):
+        """Store a transition; returns False and drops it when the buffer is full"""
+        if self.is_full():
+            self.last_added = False
+            return False
+        if self.states is None:
+            self._allocate(state.shape[-1], valid_actions.shape[-1])
+        self.states[self.idx].copy_(state.reshape(-1), non_blocking=True)
+        self.actions[self.idx] = action
+        self.rewards[self.idx] = reward
+        self.values[self.idx] = value
+        self.log_probs[self.idx] = log_prob
+        self.dones[self.idx] = done
+        self.valid_actions[self.idx] = valid_actions
+        self.idx += 1
+        self.last_added = True
+        return True
+    
+    def update_last(self, reward, done):
+        """Set reward and done flag of the most recent transition, unless it was dropped"""
+        if not self.last_added:
+            return
+        self.rewards[self.idx - 1] = reward
+        self.dones[self.idx - 1] = done
 
 class ProximalPolicyOptimization(Policy):
     def __init__(self):
@@ -150,9 +223,6 @@ class ProximalPolicyOptimization(Policy):
         # Training flag
         self.training = True
         
-        # Initialize memory
-        self.memory = PPOMemory()
-        
         # Determine device
         self.device = (
             "mps" if torch.backends.mps.is_available() 
@@ -161,12 +231,20 @@ class ProximalPolicyOptimization(Policy):
         )
         print(f"Using device: {self.device}")
         
+        # bf16 autocast for network updates on CUDA (no loss scaling needed for bf16)
+        self.use_amp = self.device == "cuda" and torch.cuda.is_bf16_supported()
+        
+        # Initialize memory
+        self.rollout_size = 128
+        self.memory = PPOMemory(self.rollout_size, self.device)
+        
         # PPO parameters
         self.clip_epsilon = 0.2
         self.gamma = 0.99
         self.gae_lambda = 0.95
         self.entropy_coef = 0.01
         self.num_epochs = 10
+        self.micro_batch_size = 32
         
         # Training setup
         self.steps = 0
@@ -174,6 +252,7 @@ class ProximalPolicyOptimization(Policy):
         
         # Model saving
         self.model_path = "saved_models/"
+        self._progress_fig = None  # Reused by plot_training_progress
         os.makedirs(self.model_path, exist_ok=True)
         
         # Initialize metrics
@@ -186,6 +265,128 @@ class ProximalPolicyOptimization(Policy):
         # Initialize reward tracking
         self.last_reward = 0
         self.reward_history = deque(maxlen=10)
+        
+        # Per-episode stock cache, filled on the first observation of an episode
+        self._episode_stocks = None
+        self._stock_index = {}
+        self._stock_sizes = None
+        self._stock_areas = None
+        self._stock_used = None
+        self._used_packed = None
+        self._used_masks = None
+        self._filled_prefix = None
+        self._empty_components = None
+        self._filled_distance = None
+        self._used_areas = None
+        self._product_order = None
+        self._pending_action = None
+        self._committed_action = None
+
+    def _episode_reset(self, observation):
+        """Rebuild the per-episode stock cache from the first observation of an episode"""
+        stocks = observation["stocks"]
+        self._episode_stocks = stocks
+        self._stock_index = {id(stock): idx for idx, stock in enumerate(stocks)}
+        
+        # Scan all stocks once as a packed int16 copy (product ids stay far below 2**15);
+        # the used-cell masks are packed in one (N, W, H) array and the per-stock masks are views
+        if len(stocks) > 0:
+            packed = np.stack(stocks, dtype=np.int16)
+            inside = packed != -2  # Same sizes as Policy._get_stock_size_
+            self._stock_sizes = np.stack(
+                (inside.any(2).sum(1), inside.any(1).sum(1)), axis=1).astype(np.int32)
+            self._stock_used = (packed >= 0).reshape(len(stocks), -1).any(1)
+            self._used_packed = packed != -1
+        else:
+            self._stock_sizes = np.zeros((0, 2), dtype=np.int32)
+            self._stock_used = np.zeros(0, dtype=bool)
+            self._used_packed = np.zeros((0, 0, 0), dtype=bool)
+        self._stock_areas = self._stock_sizes.prod(1)
+        self._used_masks = list(self._used_packed)
+        self._used_areas = np.count_nonzero(self._used_packed.reshape(len(stocks), -1), axis=1)
+        self._filled_prefix = [None] * len(stocks)
+        self._empty_components = [None] * len(stocks)
+        self._filled_distance = [None] * len(stocks)
+        
+        # Product sizes are fixed for the episode, only quantities change
+        product_sizes = np.array([product["size"] for product in observation["products"]]).reshape(-1, 2)
+        self._product_order = np.argsort(-product_sizes.prod(1), kind="stable").tolist()
+        self._committed_action = None
+    
+    def _sync_episode(self, observation):
+        """Reset the per-episode caches when the environment hands out new stocks,
+        otherwise account for the placement returned by the last get_action"""
+        if observation["stocks"] is not self._episode_stocks:
+            self._episode_reset(observation)
+        elif self._pending_action is not None:
+            self._commit_action(observation, self._pending_action)
+        self._pending_action = None
+    
+    def _commit_action(self, observation, action):
+        """Refresh the cached state of the stock the action was applied to"""
+        if action is self._committed_action:
+            return
+        self._committed_action = action
+        
+        stock_idx = action["stock_idx"]
+        pos_x, pos_y = action["position"]
+        size_w, size_h = action["size"]
+        stock_w, stock_h = self._stock_sizes[stock_idx]
+        stock = observation["stocks"][stock_idx]
+        if stock[pos_x, pos_y] < 0:
+            return  # Nothing was placed, the stock is unchanged
+        
+        self._stock_used[stock_idx] = True
+        self._filled_prefix[stock_idx] = None
+        self._empty_components[stock_idx] = None
+        self._filled_distance[stock_idx] = None
+        
+        used_mask = self._used_masks[stock_idx]
+        if (pos_x + size_w <= stock_w and pos_y + size_h <= stock_h
+                and not used_mask[pos_x:pos_x + size_w, pos_y:pos_y + size_h].any()):
+            # The piece landed on cells known to be free: update the caches in place
+            used_mask[pos_x:pos_x + size_w, pos_y:pos_y + size_h] = True
+            self._used_areas[stock_idx] += size_w * size_h
+        else:
+            np.not_equal(stock, -1, out=used_mask)
+            self._used_areas[stock_idx] = np.count_nonzero(used_mask)
+    
+    def _get_used_mask(self, stock):
+        """Boolean mask of non-empty cells, kept up to date for the stocks of the episode"""
+        idx = self._stock_index.get(id(stock))
+        if idx is None:
+            return stock != -1
+        return self._used_masks[idx]
+    
+    def _get_used_area(self, stock):
+        """Number of non-empty cells of a single stock"""
+        idx = self._stock_index.get(id(stock))
+        if idx is None:
+            return np.count_nonzero(self._get_used_mask(stock))
+        return self._used_areas[idx]
+    
+    def _can_place_(self, stock, position, prod_size):
+        pos_x, pos_y = position
+        prod_w, prod_h = prod_size
+        
+        idx = self._stock_index.get(id(stock))
+        if idx is None:
+            return not self._get_used_mask(stock)[pos_x : pos_x + prod_w, pos_y : pos_y + prod_h].any()
+        
+        # Pieces must lie inside the stock; the rest is four lookups in the summed-area table
+        stock_w, stock_h = self._stock_sizes[idx]
+        if pos_x < 0 or pos_y < 0 or pos_x + prod_w > stock_w or pos_y + prod_h > stock_h:
+            return False
+        filled = self._get_filled_prefix_sum(stock)
+        end_x, end_y = pos_x + prod_w, pos_y + prod_h
+        return filled[end_x, end_y] - filled[pos_x, end_y] - filled[end_x, pos_y] + filled[pos_x, pos_y] == 0
+    
+    def _get_stock_size_(self, stock):
+        """Stock size, served from the per-episode cache for stocks of the current episode"""
+        idx = self._stock_index.get(id(stock))
+        if idx is None:
+            return super()._get_stock_size_(stock)
+        return self._stock_sizes[idx]
 
     def initialize_networks(self, observation):
         """Initialize networks after getting first observation"""
@@ -204,9 +405,20 @@ class ProximalPolicyOptimization(Policy):
             self.actor = ActorNetwork(self.state_dim, self.action_dim).to(self.device)
             self.critic = CriticNetwork(self.state_dim).to(self.device)
             
+            # Compiled forward passes on CUDA; the modules themselves stay uncompiled
+            # so state dicts keep their keys and old checkpoints still load
+            if self.device == "cuda":
+                self.actor_forward = torch.compile(self.actor, mode="reduce-overhead", dynamic=False)
+                self.critic_forward = torch.compile(self.critic, mode="reduce-overhead", dynamic=False)
+            else:
+                self.actor_forward = self.actor
+                self.critic_forward = self.critic
+            
             # Initialize optimizers
             self.actor_optimizer = optim.Adam(self.actor.parameters(), lr=3e-4)
-            self.critic_optimizer = optim.Adam(self.critic.parameters(), lr=1e-3)
+            # L2 regularization: the former 0.01 * sum(p ** 2) loss term has gradient 0.02 * p.
+            # Adam adds the decay after gradient clipping, where the loss term was clipped with the rest
+            self.critic_optimizer = optim.Adam(self.critic.parameters(), lr=1e-3, weight_decay=0.02)
             
             # Initialize schedulers
             self.actor_scheduler = optim.lr_scheduler.ReduceLROnPlateau(
@@ -217,56 +429,57 @@ class ProximalPolicyOptimization(Policy):
             # Initialize state normalization
             self.state_mean = torch.zeros(self.state_dim).to(self.device)
             self.state_std = torch.ones(self.state_dim).to(self.device)
+            self._refresh_state_normalizer()
+            
+            # Reusable host buffer for the state vector (pinned for async H2D copies)
+            self._state_buf = torch.empty(
+                self.state_dim, dtype=torch.float32, pin_memory=(self.device == "cuda"))
+            self._state_np = self._state_buf.numpy()
 
     def preprocess_observation(self, observation, info):
         """Convert observation to state tensor with fixed dimensions"""
-        stocks = observation["stocks"]
-        products = observation["products"]
+        stocks = observation["stocks"][:100]
+        products = observation["products"][:self.max_products]
+        state = self._state_np
         
         # Stock features - ensure 100 stocks
-        stock_features = []
-        for stock in stocks[:100]:
-            stock_w, stock_h = self._get_stock_size_(stock)
-            used_space = np.sum(stock != -1)
-            total_space = stock_w * stock_h
-            stock_features.extend([
-                stock_w / 10.0,  # Normalized width
-                stock_h / 10.0,  # Normalized height
-                used_space / total_space  # Utilization ratio
-            ])
-        
-        # Pad if lacking stocks
-        while len(stock_features) < 300:
-            stock_features.extend([0, 0, 0])
+        stock_features = state[:300].reshape(100, 3)
+        stock_features.fill(0)  # Pad if lacking stocks
+        if len(stocks) > 0:
+            num_stocks = len(stocks)
+            used_space = self._used_areas[:num_stocks]
+            stock_features[:num_stocks, :2] = self._stock_sizes[:num_stocks] / 10.0  # Normalized width, height
+            stock_features[:num_stocks, 2] = used_space / self._stock_areas[:num_stocks]  # Utilization ratio
         
         # Product features - ensure max_products
-        prod_features = []
-        for prod in products[:self.max_products]:
-            if prod["quantity"] > 0:
-                prod_features.extend([
-                    prod["size"][0] / 10.0,  # Normalized width
-                    prod["size"][1] / 10.0,  # Normalized height
-                    min(prod["quantity"], 10) / 10.0  # Normalized quantity
-                ])
-        
-        # Pad if lacking products
-        while len(prod_features) < self.max_products * 3:
-            prod_features.extend([0, 0, 0])
+        prod_end = 300 + self.max_products * 3
+        prod_features = np.fromiter(
+            (value
+             for prod in products if prod["quantity"] > 0
+             for value in (prod["size"][0] / 10.0,  # Normalized width
+                           prod["size"][1] / 10.0,  # Normalized height
+                           min(prod["quantity"], 10) / 10.0)),  # Normalized quantity
+            dtype=np.float32)
+        state[300:300 + len(prod_features)] = prod_features
+        state[300 + len(prod_features):prod_end] = 0  # Pad if lacking products
         
         # Global features
-        global_features = [
-            info.get('filled_ratio', 0),
-            self.steps / 1000.0  # Normalized step count
-        ]
-        
-        # Combine all features
-        state = np.array(stock_features + prod_features + global_features, dtype=np.float32)
-        return torch.FloatTensor(state)
+        state[prod_end] = info.get('filled_ratio', 0)
+        state[prod_end + 1] = self.steps / 1000.0  # Normalized step count
+        
+        # Normalize in place while the state is still on the host
+        self._state_buf.sub_(self._state_mean_cpu).div_(self._state_denom_cpu)
+        
+        # The host buffer is reused by the next call; on CPU .to() would return it as is
+        if self.device == "cpu":
+            return self._state_buf.clone()
+        return self._state_buf.to(self.device, non_blocking=True)
 
     def get_action(self, observation, info):
         # Initialize networks if first time
         if self.max_products is None:
             self.initialize_networks(observation)
+        self._sync_episode(observation)
         
         remaining_products = sum(prod["quantity"] for prod in observation["products"])
         
@@ -274,6 +487,7 @@ class ProximalPolicyOptimization(Policy):
         if self.steps < 2000 or remaining_products > 0.7 * self.initial_products:
             placement_action = self._get_structured_placement(observation)
             if placement_action is not None:
+                self._pending_action = placement_action
                 return placement_action
         
         # Modified largest-first strategy
@@ -281,28 +495,37 @@ class ProximalPolicyOptimization(Policy):
         if largest_product:
             best_stock_idx = self.find_best_fitting_stock(observation, largest_product["size"])
             if best_stock_idx is not None:
-                state = self.preprocess_observation(observation, info)
-                state = self.normalize_state(state).unsqueeze(0)
+                # Update on a full rollout first, so this transition is not dropped
+                if self.training and self.memory.is_full():
+                    self._update_networks()
+                    self.memory.clear()
+                
+                state = self.preprocess_observation(observation, info).unsqueeze(0)
                 
                 with torch.no_grad():
-                    logits = self.actor(state).squeeze(0)
+                    logits = self.actor_forward(state).squeeze(0)
                     
                     # Stronger bias towards best stock during early training
                     boost_factor = max(3.0 - (self.steps / 10000), 1.0)
                     stock_actions = torch.arange(25, device=self.device) + (best_stock_idx * 25)
                     logits[stock_actions] += boost_factor
                     
+                    # Rule out actions that cannot lead to a placement
+                    valid_actions = self._get_valid_action_mask(observation)
+                    logits = logits.masked_fill(~valid_actions, -1e9)
+                    
                     # Adaptive temperature
                     temperature = max(1.0 - (self.steps / 20000), 0.1)
                     logits = logits / temperature
                     
-                    dist = torch.distributions.Categorical(logits=logits)
-                    action = dist.sample()
+                    # Sample directly from the softmax, no Distribution object per step
+                    log_probs = F.log_softmax(logits, dim=-1)
+                    action = torch.multinomial(log_probs.exp(), 1).squeeze(-1)
                     
                     if self.training:
-                        log_prob = dist.log_prob(action)
-                        value = self.critic(state)
-                        self.memory.add(state.cpu(), action.item(), 0, value.item(), log_prob.item(), False)
+                        log_prob = log_probs[action]
+                        value = self.critic_forward(state)
+                        self.memory.add(state, action, 0, value.squeeze(), log_prob, False, valid_actions)
         
         # Convert to actual placement action
         placement_action = self.convert_action(action.item(), observation)
@@ -312,8 +535,32 @@ class ProximalPolicyOptimization(Policy):
             placement_action = self._get_greedy_action(observation)
         
         self.steps += 1
+        self._pending_action = placement_action
         return placement_action
 
+    def _get_valid_action_mask(self, observation):
+        """Mask of actor outputs that map to a stock some remaining product still fits in"""
+        num_stocks = len(observation["stocks"])
+        valid_actions = np.zeros(self.actor.action_dim, dtype=bool)
+        
+        sizes = np.array([prod["size"] for prod in observation["products"]
+                          if prod["quantity"] > 0]).reshape(-1, 2)
+        if len(sizes) > 0:
+            # A product fits a stock in some orientation iff both its short and long sides fit
+            stock_short = self._stock_sizes.min(1)[:, None]
+            stock_long = self._stock_sizes.max(1)[:, None]
+            free_area = (self._used_packed[0].size - self._used_areas)[:, None]
+            fits = ((sizes.min(1) <= stock_short) & (sizes.max(1) <= stock_long)
+                    & (sizes.prod(1) <= free_area)).any(1)
+            
+            # Both halves of the action space address the stocks; outputs past them
+            # are clipped onto the last stock by convert_action and stay masked
+            stock_actions = np.repeat(fits, 25)
+            valid_actions[:num_stocks * 25] = stock_actions
+            valid_actions[num_stocks * 25:num_stocks * 50] = stock_actions
+        
+        return torch.from_numpy(valid_actions).to(self.device)
+
     def normalize_state(self, state):
         state = torch.FloatTensor(state).to(self.device)
         return (state - self.state_mean) / (self.state_std + 1e-8)
@@ -322,6 +569,15 @@ class ProximalPolicyOptimization(Policy):
         state = torch.FloatTensor(state).to(self.device)
         self.state_mean = 0.99 * self.state_mean + 0.01 * state.mean()
         self.state_std = 0.99 * self.state_std + 0.01 * state.std()
+        self._refresh_state_normalizer()
+    
+    def _refresh_state_normalizer(self):
+        """Host copies of the normalization statistics used by preprocess_observation"""
+        self._state_mean_cpu = self.state_mean.detach().to("cpu", torch.float32)
+        self._state_denom_cpu = (self.state_std.detach() + 1e-8).to("cpu", torch.float32)
+        if self.device == "cuda":
+            self._state_mean_cpu = self._state_mean_cpu.pin_memory()
+            self._state_denom_cpu = self._state_denom_cpu.pin_memory()
     
     def convert_action(self, action_idx, observation):
         """Convert network output to placement parameters with enhanced rotation"""
@@ -340,38 +596,47 @@ class ProximalPolicyOptimization(Policy):
         best_action = None
         best_pattern_score = float('-inf')
         
-        for prod in observation["products"]:
-            if prod["quantity"] > 0:
-                stock = observation["stocks"][stock_idx]
-                stock_w, stock_h = self._get_stock_size_(stock)
+        stock = observation["stocks"][stock_idx]
+        stock_w, stock_h = self._stock_sizes[stock_idx]
+        products = [prod for prod in observation["products"] if prod["quantity"] > 0]
+        
+        if products:
+            # Candidate sizes: original then rotated orientation of every product
+            sizes = np.array([
+                size
+                for prod in products
+                for size in ((prod["size"][0], prod["size"][1]), (prod["size"][1], prod["size"][0]))
+            ])
+            is_rotated = np.tile([False, True], len(products)) & (sizes[:, 0] != sizes[:, 1])
+            
+            # Scale position to actual stock size
+            scaled_x = np.minimum(int(pos_x * stock_w / 5), stock_w - sizes[:, 0])
+            scaled_y = np.minimum(int(pos_y * stock_h / 5), stock_h - sizes[:, 1])
+            
+            # Test every candidate that fits inside the stock at once
+            candidates = np.flatnonzero((scaled_x >= 0) & (scaled_y >= 0))
+            filled = self._get_filled_prefix_sum(stock)
+            x0, y0 = scaled_x[candidates], scaled_y[candidates]
+            x1, y1 = x0 + sizes[candidates, 0], y0 + sizes[candidates, 1]
+            filled_cells = filled[x1, y1] - filled[x0, y1] - filled[x1, y0] + filled[x0, y0]
+            
+            for i in candidates[filled_cells == 0]:
+                prod_w, prod_h = int(sizes[i, 0]), int(sizes[i, 1])
+                pattern_score = self.evaluate_placement_pattern(
+                    stock, int(scaled_x[i]), int(scaled_y[i]), prod_w, prod_h
+                )
                 
-                # Try both original and rotated orientations
-                orientations = [
-                    list(prod["size"]),  # Original orientation
-                    [prod["size"][1], prod["size"][0]]  # Rotated orientation
-                ]
+                # Prefer rotated orientation if it results in better utilization
+                if is_rotated[i]:
+                    pattern_score *= 1.1  # Small bonus for successful rotation
                 
-                for prod_size in orientations:
-                    # Scale position to actual stock size
-                    scaled_x = min(int(pos_x * stock_w / 5), stock_w - prod_size[0])
-                    scaled_y = min(int(pos_y * stock_h / 5), stock_h - prod_size[1])
-                    
-                    if self._can_place_(stock, (scaled_x, scaled_y), prod_size):
-                        pattern_score = self.evaluate_placement_pattern(
-                            stock, scaled_x, scaled_y, prod_size[0], prod_size[1]
-                        )
-                        
-                        # Prefer rotated orientation if it results in better utilization
-                        if prod_size != list(prod["size"]):  # If this is the rotated version
-                            pattern_score *= 1.1  # Small bonus for successful rotation
-                        
-                        if pattern_score > best_pattern_score:
-                            best_pattern_score = pattern_score
-                            best_action = {
-                                "stock_idx": stock_idx,
-                                "size": prod_size,
-                                "position": (scaled_x, scaled_y)
-                            }
+                if pattern_score > best_pattern_score:
+                    best_pattern_score = pattern_score
+                    best_action = {
+                        "stock_idx": stock_idx,
+                        "size": [prod_w, prod_h],
+                        "position": (int(scaled_x[i]), int(scaled_y[i]))
+                    }
         
         # Fallback to random valid action if needed
         if best_action is None:
@@ -379,63 +644,99 @@ class ProximalPolicyOptimization(Policy):
         
         return best_action
     
+    def _get_filled_prefix_sum(self, stock):
+        """Summed-area table of filled cells, padded so that entry [x, y] covers stock[:x, :y];
+        computed once per stock until it is cut again"""
+        idx = self._stock_index.get(id(stock))
+        if idx is not None and self._filled_prefix[idx] is not None:
+            return self._filled_prefix[idx]
+        filled = np.zeros((stock.shape[0] + 1, stock.shape[1] + 1), dtype=np.int32)
+        np.cumsum(np.cumsum(self._get_used_mask(stock), axis=0, dtype=np.int32), axis=1, out=filled[1:, 1:])
+        if idx is not None:
+            self._filled_prefix[idx] = filled
+        return filled
+    
+    def _get_free_windows(self, filled, stock_w, stock_h, prod_w, prod_h):
+        """Boolean map [x, y] of top-left positions where a prod_w x prod_h piece covers no filled cell"""
+        free_w, free_h = stock_w - prod_w + 1, stock_h - prod_h + 1
+        window_filled = (filled[prod_w:stock_w + 1, prod_h:stock_h + 1]
+                         - filled[:free_w, prod_h:stock_h + 1]
+                         - filled[prod_w:stock_w + 1, :free_h]
+                         + filled[:free_w, :free_h])
+        return window_filled == 0
+    
+    def _get_skyline_positions(self, filled, stock_w, stock_h, prod_w, prod_h):
+        """Free top-left positions [x, y] where the piece rests on the skyline: it cannot slide
+        towards x = 0 or y = 0 without hitting a filled cell or the stock border"""
+        free_w, free_h = stock_w - prod_w + 1, stock_h - prod_h + 1
+        positions = self._get_free_windows(filled, stock_w, stock_h, prod_w, prod_h)
+        
+        # Filled cells in the row just below / the column just left of each position
+        cols_filled = filled[prod_w:stock_w + 1, :free_h] - filled[:free_w, :free_h]
+        rows_filled = filled[:free_w, prod_h:stock_h + 1] - filled[:free_w, :free_h]
+        positions[:, 1:] &= cols_filled[:, 1:] > cols_filled[:, :-1]
+        positions[1:, :] &= rows_filled[1:, :] > rows_filled[:-1, :]
+        return positions
+    
     def compute_gae(self, rewards, values, dones):
         """
         Computes the Generalized Advantage Estimation (GAE) for a given trajectory.
 
         Args:
-            rewards (list): A list of rewards for the trajectory.
-            values (list): A list of estimated values for the trajectory.
-            dones (list): A list of done flags for the trajectory.
+            rewards (torch.Tensor): A tensor of rewards for the trajectory.
+            values (torch.Tensor): A tensor of estimated values for the trajectory.
+            dones (torch.Tensor): A tensor of done flags for the trajectory.
 
         Returns:
             torch.Tensor: A tensor of shape (trajectory length,) containing the GAE values.
         """
-        advantages = []
-        gae = 0
-        
-        for t in reversed(range(len(rewards))):
-            if t == len(rewards) - 1:
-                next_value = 0
-            else:
-                next_value = values[t + 1]
-                
-            delta = rewards[t] + self.gamma * next_value * (1 - dones[t]) - values[t]
-            gae = delta + self.gamma * self.gae_lambda * (1 - dones[t]) * gae
-            advantages.insert(0, gae)
+        # TD residuals and decay factors for all timesteps at once
+        not_done = 1 - dones
+        next_values = torch.cat([values[1:], values.new_zeros(1)])
+        deltas = rewards + self.gamma * next_values * not_done - values
+        factors = self.gamma * self.gae_lambda * not_done
+        
+        # The reverse recurrence is sequential; run it on host floats in one pass
+        deltas = deltas.detach().cpu().numpy()
+        factors = factors.detach().cpu().numpy()
+        advantages = np.empty_like(deltas)
+        gae = 0.0
+        for t in reversed(range(len(deltas))):
+            gae = deltas[t] + factors[t] * gae
+            advantages[t] = gae
             
-        return torch.tensor(advantages, dtype=torch.float32).to(self.device)
+        return torch.from_numpy(advantages).to(self.device)
     
     def update_policy(self, reward=None, done=None, info=None):
         """Update policy with corrected filled ratio"""
         # Update the last memory entry with the current reward and done status
-        if reward is not None and len(self.memory.rewards) > 0:
-            self.memory.rewards[-1] = reward
-            self.memory.dones[-1] = done
+        if reward is not None and len(self.memory) > 0:
+            self.memory.update_last(reward, done)
             
             # Update metrics with correct filled ratio if info is provided
             if info and 'observation' in info:
                 correct_filled_ratio = self.calculate_filled_ratio(info['observation'])
-                if len(self.metrics.running_averages['filled_ratio']) > 0:
-                    self.metrics.running_averages['filled_ratio'][-1] = correct_filled_ratio
+                self.metrics.set_last_running_value('filled_ratio', correct_filled_ratio)
 
         # Only perform PPO update when we have enough experience
-        if len(self.memory.states) >= 128:
+        if len(self.memory) >= self.rollout_size:
             self._update_networks()
             self.memory.clear()
 
     def _update_networks(self):
         """Internal method to perform the actual PPO update"""
-        if not self.training or len(self.memory.states) == 0:
+        num_samples = len(self.memory)
+        if not self.training or num_samples == 0:
             return
             
-        # Convert memory to tensors
-        states = torch.stack(self.memory.states).to(self.device)
-        actions = torch.tensor(self.memory.actions).to(self.device)
-        rewards = torch.tensor(self.memory.rewards, dtype=torch.float32).to(self.device)
-        old_values = torch.tensor(self.memory.values, dtype=torch.float32).to(self.device)
-        old_log_probs = torch.tensor(self.memory.log_probs, dtype=torch.float32).to(self.device)
-        dones = torch.tensor(self.memory.dones, dtype=torch.float32).to(self.device)
+        # Views of the filled part of the rollout buffers
+        states = self.memory.states[:num_samples]
+        actions = self.memory.actions[:num_samples]
+        rewards = self.memory.rewards[:num_samples]
+        old_values = self.memory.values[:num_samples]
+        old_log_probs = self.memory.log_probs[:num_samples]
+        dones = self.memory.dones[:num_samples]
+        valid_actions = self.memory.valid_actions[:num_samples]
         
         # Calculate advantages and returns
         advantages = self.compute_gae(rewards, old_values, dones)
@@ -445,48 +746,60 @@ class ProximalPolicyOptimization(Policy):
         returns = (returns - returns.mean()) / (returns.std() + 1e-8)
         advantages = (advantages - advantages.mean()) / (advantages.std() + 1e-8)
         
-        print(f"\nUpdating networks with {len(self.memory.states)} samples...")
+        print(f"\nUpdating networks with {num_samples} samples...")
         
         # PPO update loop
         for _ in range(self.num_epochs):
-            # Get current policy distributions
-            logits = self.actor(states)
-            dist = torch.distributions.Categorical(logits=logits)
-            new_log_probs = dist.log_prob(actions)
-            entropy = dist.entropy().mean()
-            
-            # Calculate policy ratio and clipped surrogate objective
-            ratio = torch.exp(new_log_probs - old_log_probs)
-            surr1 = ratio * advantages
-            surr2 = torch.clamp(ratio, 1 - self.clip_epsilon, 1 + self.clip_epsilon) * advantages
-            actor_loss = -torch.min(surr1, surr2).mean()
+            self.actor_optimizer.zero_grad()
+            self.critic_optimizer.zero_grad()
+            epoch_actor_loss = 0.0
+            epoch_critic_loss = 0.0
             
-            # Value function loss với L2 regularization
-            value_pred = self.critic(states)
-            l2_reg = 0.01
-            critic_reg_loss = 0
-            for param in self.critic.parameters():
-                critic_reg_loss += torch.sum(param ** 2)
+            # Accumulate gradients over micro-batches, weighted by their share of the rollout
+            for start in range(0, num_samples, self.micro_batch_size):
+                batch = slice(start, start + self.micro_batch_size)
+                weight = (min(start + self.micro_batch_size, num_samples) - start) / num_samples
+                
+                # Forward passes, in bf16 when available; losses are computed in fp32
+                with torch.autocast(device_type="cuda", dtype=torch.bfloat16, enabled=self.use_amp):
+                    logits = self.actor_forward(states[batch])
+                    value_pred = self.critic_forward(states[batch]).squeeze(-1)
+                logits = logits.float().masked_fill(~valid_actions[batch], -1e9)
+                value_pred = value_pred.float()
+                
+                # Log-probabilities of the taken actions and entropy of the current policy,
+                # under the same action mask the rollout sampled from
+                log_probs = F.log_softmax(logits, dim=-1)
+                new_log_probs = log_probs.gather(-1, actions[batch].unsqueeze(-1)).squeeze(-1)
+                entropy = -(log_probs.exp() * log_probs).sum(-1).mean()
                 
-            value_clipped = old_values + torch.clamp(
-                value_pred - old_values, -self.clip_epsilon, self.clip_epsilon
-            )
-            value_loss_1 = (value_pred - returns).pow(2)
-            value_loss_2 = (value_clipped - returns).pow(2)
-            critic_loss = 0.25 * torch.max(value_loss_1, value_loss_2).mean() + l2_reg * critic_reg_loss
+                # Calculate policy ratio and clipped surrogate objective
+                ratio = torch.exp(new_log_probs - old_log_probs[batch])
+                surr1 = ratio * advantages[batch]
+                surr2 = torch.clamp(ratio, 1 - self.clip_epsilon, 1 + self.clip_epsilon) * advantages[batch]
+                actor_loss = -torch.min(surr1, surr2).mean()
+                
+                # Value function loss (L2 regularization is applied by the critic optimizer)
+                value_clipped = old_values[batch] + torch.clamp(
+                    value_pred - old_values[batch], -self.clip_epsilon, self.clip_epsilon
+                )
+                value_loss_1 = (value_pred - returns[batch]).pow(2)
+                value_loss_2 = (value_clipped - returns[batch]).pow(2)
+                critic_loss = 0.25 * torch.max(value_loss_1, value_loss_2).mean()
+                
+                # Total loss với entropy bonus nhỏ hơn
+                total_loss = actor_loss + critic_loss - 0.01 * entropy  # Giảm entropy coefficient
+                (total_loss * weight).backward()
+                
+                epoch_actor_loss += actor_loss.detach() * weight
+                epoch_critic_loss += critic_loss.detach() * weight
             
             # Store the losses
-            self.last_actor_loss = actor_loss.item()
-            self.last_critic_loss = critic_loss.item()
-            
-            # Total loss với entropy bonus nhỏ hơn
-            total_loss = actor_loss + critic_loss - 0.01 * entropy  # Giảm entropy coefficient
-            print(f"Losses - Actor: {actor_loss.item():.3f}, Critic: {critic_loss.item():.3f}")
+            self.last_actor_loss = epoch_actor_loss.item()
+            self.last_critic_loss = epoch_critic_loss.item()
+            print(f"Losses - Actor: {self.last_actor_loss:.3f}, Critic: {self.last_critic_loss:.3f}")
             
             # Update với gradient clipping mạnh hơn
-            self.actor_optimizer.zero_grad()
-            self.critic_optimizer.zero_grad()
-            total_loss.backward()
             torch.nn.utils.clip_grad_norm_(self.actor.parameters(), 0.1)  # Giảm max norm
             torch.nn.utils.clip_grad_norm_(self.critic.parameters(), 0.1)
             self.actor_optimizer.step()
@@ -495,7 +808,7 @@ class ProximalPolicyOptimization(Policy):
         # Update learning rates
         mean_reward = rewards.mean().item()
         self.actor_scheduler.step(mean_reward)
-        self.critic_scheduler.step(critic_loss.item())
+        self.critic_scheduler.step(self.last_critic_loss)
     
     def save_model(self, filename):
         if not filename.endswith('.pt'):
@@ -507,17 +820,21 @@ class ProximalPolicyOptimization(Policy):
             'critic_optimizer_state_dict': self.critic_optimizer.state_dict(),
             'state_mean': self.state_mean,
             'state_std': self.state_std,
-        }, os.path.join(self.model_path, filename))
+        }, os.path.join(self.model_path, filename), _use_new_zipfile_serialization=True)
     
     def load_model(self, filename):
         try:
-            checkpoint = torch.load(os.path.join(self.model_path, filename))
+            # Load on the host; load_state_dict copies into the device params. No mmap: on CPU the
+            # loaded tensors would stay backed by the file that save_model later overwrites
+            checkpoint = torch.load(os.path.join(self.model_path, filename),
+                                    map_location='cpu', weights_only=True)
             self.actor.load_state_dict(checkpoint['actor_state_dict'])
             self.critic.load_state_dict(checkpoint['critic_state_dict'])
             self.actor_optimizer.load_state_dict(checkpoint['actor_optimizer_state_dict'])
             self.critic_optimizer.load_state_dict(checkpoint['critic_optimizer_state_dict'])
-            self.state_mean = checkpoint['state_mean']
-            self.state_std = checkpoint['state_std']
+            self.state_mean = checkpoint['state_mean'].to(self.device, non_blocking=True)
+            self.state_std = checkpoint['state_std'].to(self.device, non_blocking=True)
+            self._refresh_state_normalizer()
             return True
         except:
             return False
@@ -527,6 +844,8 @@ class ProximalPolicyOptimization(Policy):
         if action is None:
             return -10.0
         
+        self._sync_episode(observation)
+        self._commit_action(observation, action)
         reward = 0
         current_filled_ratio = self.calculate_filled_ratio(observation)  # Use corrected ratio
         filled_ratio_change = current_filled_ratio - self.prev_filled_ratio
@@ -535,13 +854,16 @@ class ProximalPolicyOptimization(Policy):
         stock = observation["stocks"][action["stock_idx"]]
         pos_x, pos_y = action["position"]
         size_w, size_h = action["size"]
-        stock_w, stock_h = self._get_stock_size_(stock)
+        stock_w, stock_h = self._stock_sizes[action["stock_idx"]]
         piece_area = size_w * size_h
         
+        # The helpers below all read this stock's cached used-cell mask
+        used_area = self._get_used_area(stock)
+        
         # 1. Scattered Placement Penalty (Controlled Exponential)
         adjacent_count = self._count_adjacent_pieces(stock, pos_x, pos_y, size_w, size_h)
         if adjacent_count == 0:
-            if np.sum(stock != -1) > 0:
+            if used_area > 0:
                 distance = self._get_distance_to_filled(stock, pos_x, pos_y)
                 # Limit the maximum distance penalty
                 scatter_penalty = -5.0 * min(8, (1.5 ** min(distance, 4)))
@@ -552,11 +874,7 @@ class ProximalPolicyOptimization(Policy):
             reward += adjacency_reward
         
         # 2. Top-Down Fill Violation (Controlled Penalty)
-        empty_cells_above = 0
-        for x in range(pos_x, pos_x + size_w):
-            for y in range(0, pos_y):
-                if stock[y, x] == -1:
-                    empty_cells_above += 1
+        empty_cells_above = self._count_gaps_above(stock, pos_x, pos_y, size_w)
         if empty_cells_above > 0:
             # Limit the vertical penalty
             vertical_penalty = -1.0 * min(10, (1.2 ** min(empty_cells_above, 5)))
@@ -569,8 +887,8 @@ class ProximalPolicyOptimization(Policy):
             reward += 4.0
         
         # 4. New Stock Penalty (Controlled Exponential)
-        if np.sum(stock != -1) == piece_area:
-            used_stocks = sum(1 for s in observation["stocks"] if np.any(s != -1))
+        if used_area == piece_area:
+            used_stocks = np.count_nonzero(self._stock_used)
             if piece_area < stock_w * stock_h * 0.3:
                 # Limit the new stock penalty
                 new_stock_penalty = -5.0 * min(8, (1.2 ** min(used_stocks, 5)))
@@ -593,35 +911,56 @@ class ProximalPolicyOptimization(Policy):
 
     def _count_adjacent_pieces(self, stock, pos_x, pos_y, size_w, size_h):
         """Enhanced adjacent piece counting with stronger weights for direct adjacency"""
-        count = 0
-        padding = 1
-        
-        # Check all sides and corners
-        for dx in range(-padding, size_w + padding):
-            for dy in range(-padding, size_h + padding):
-                # Skip the cells where the piece will be placed
-                if 0 <= dx < size_w and 0 <= dy < size_h:
-                    continue
-                    
-                check_x = pos_x + dx
-                check_y = pos_y + dy
-                
-                if (0 <= check_x < stock.shape[1] and 
-                    0 <= check_y < stock.shape[0]):
-                    if stock[check_y, check_x] != -1:
-                        # Much higher weight for direct adjacency vs diagonal
-                        if dx in [0, size_w] or dy in [0, size_h]:
-                            count += 2.0  # Increased from 1.5
-                        else:
-                            count += 0.25  # Reduced diagonal weight
-        
-        return count
+        right_x = pos_x + size_w
+        
+        # Filled cells in the one-cell border around the piece (corners in top/bottom rows)
+        top, bottom, left, right = (
+            self._count_filled_in_region(stock, *border)
+            for border in self._get_border_regions(pos_x, pos_y, size_w, size_h)
+        )
+        
+        # Border cells lying on the piece's first or past-the-end row/column count as direct
+        direct = (bottom + right
+                  + self._count_filled_in_region(stock, pos_x, pos_y - 1, pos_x + 1, pos_y)
+                  + self._count_filled_in_region(stock, right_x, pos_y - 1, right_x + 1, pos_y)
+                  + self._count_filled_in_region(stock, pos_x - 1, pos_y, pos_x, pos_y + 1))
+        diagonal = top + bottom + left + right - direct
+        
+        # Much higher weight for direct adjacency vs diagonal
+        return 2.0 * direct + 0.25 * diagonal
+
+    def _get_border_regions(self, pos_x, pos_y, size_w, size_h):
+        """Top, bottom, left and right strips of the one-cell border around a piece"""
+        right_x = pos_x + size_w
+        bottom_y = pos_y + size_h
+        return (
+            (pos_x - 1, pos_y - 1, right_x + 1, pos_y),
+            (pos_x - 1, bottom_y, right_x + 1, bottom_y + 1),
+            (pos_x - 1, pos_y, pos_x, bottom_y),
+            (right_x, pos_y, right_x + 1, bottom_y),
+        )
+
+    def _clip_region(self, stock, x_start, y_start, x_end, y_end):
+        """Return stock[y_start:y_end, x_start:x_end] clipped to the stock bounds"""
+        x_start, y_start = max(0, x_start), max(0, y_start)
+        x_end = max(x_start, min(stock.shape[1], x_end))
+        y_end = max(y_start, min(stock.shape[0], y_end))
+        return stock[y_start:y_end, x_start:x_end]
+
+    def _count_filled_in_region(self, stock, x_start, y_start, x_end, y_end):
+        """Count filled cells in a region clipped to the stock bounds"""
+        return np.count_nonzero(self._clip_region(self._get_used_mask(stock), x_start, y_start, x_end, y_end))
+
+    def _count_empty_in_region(self, stock, x_start, y_start, x_end, y_end):
+        """Count empty cells in a region clipped to the stock bounds"""
+        region = self._clip_region(self._get_used_mask(stock), x_start, y_start, x_end, y_end)
+        return region.size - np.count_nonzero(region)
 
     def calculate_stock_filled_ratio(self, stock):
         """Calculate filled ratio for a single stock"""
         stock_w, stock_h = self._get_stock_size_(stock)
         total_area = stock_w * stock_h
-        used_area = np.sum(stock != -1)
+        used_area = self._get_used_area(stock)
         return used_area / total_area
     
     def calculate_space_utilization(self, stock, pos_x, pos_y, size_w, size_h):
@@ -656,7 +995,8 @@ class ProximalPolicyOptimization(Policy):
         return space_efficiency * 3.0 + remaining_ratio * 2.0
 
     def calculate_stock_penalty(self, observation):
-        used_stocks = sum(1 for stock in observation['stocks'] if np.any(stock > 0))
+        self._sync_episode(observation)
+        used_stocks = np.count_nonzero(self._stock_used)
         stock_penalty = -0.2 * used_stocks
         return stock_penalty
 
@@ -683,7 +1023,8 @@ class ProximalPolicyOptimization(Policy):
     def _get_random_valid_action(self, observation, allow_rotation=True):
         """Get a random valid action with optional rotation"""
         for stock_idx, stock in enumerate(observation["stocks"]):
-            stock_w, stock_h = self._get_stock_size_(stock)
+            stock_w, stock_h = self._stock_sizes[stock_idx]
+            filled = self._get_filled_prefix_sum(stock)
             
             for prod in observation["products"]:
                 if prod["quantity"] > 0:
@@ -693,16 +1034,20 @@ class ProximalPolicyOptimization(Policy):
                         orientations.append((prod["size"][1], prod["size"][0]))
                     
                     for prod_w, prod_h in orientations:
-                        for _ in range(10):
-                            pos_x = np.random.randint(0, stock_w - prod_w + 1)
-                            pos_y = np.random.randint(0, stock_h - prod_h + 1)
-                            
-                            if self._can_place_(stock, (pos_x, pos_y), (prod_w, prod_h)):
-                                return {
-                                    "stock_idx": stock_idx,
-                                    "size": (prod_w, prod_h),
-                                    "position": (pos_x, pos_y)
-                                }
+                        if prod_w > stock_w or prod_h > stock_h:
+                            continue
+                        
+                        # Every free top-left position at once
+                        valid_positions = np.argwhere(
+                            self._get_free_windows(filled, stock_w, stock_h, prod_w, prod_h))
+                        
+                        if len(valid_positions) > 0:
+                            pos_x, pos_y = valid_positions[np.random.randint(len(valid_positions))]
+                            return {
+                                "stock_idx": stock_idx,
+                                "size": (prod_w, prod_h),
+                                "position": (int(pos_x), int(pos_y))
+                            }
         
         return None
     
@@ -717,17 +1062,13 @@ class ProximalPolicyOptimization(Policy):
         size_w, size_h = action['size']
         
         # Calculate metrics
-        edge_contact = 0
-        if pos_x == 0 or pos_x + size_w == stock_w:
-            edge_contact += 1
-        if pos_y == 0 or pos_y + size_h == stock_h:
-            edge_contact += 1
+        edge_x = bool(pos_x == 0) | bool(pos_x + size_w == stock_w)
+        edge_y = bool(pos_y == 0) | bool(pos_y + size_h == stock_h)
+        edge_contact = edge_x + edge_y
+        is_corner = edge_x & edge_y
         
-        is_corner = (pos_x == 0 or pos_x + size_w == stock_w) and \
-                   (pos_y == 0 or pos_y + size_h == stock_h)
-        
-        self.metrics.episode_metrics['edge_utilization'].append(edge_contact)
-        self.metrics.episode_metrics['corner_placements'].append(int(is_corner))
+        self.metrics.add_metric_value('edge_utilization', edge_contact)
+        self.metrics.add_metric_value('corner_placements', is_corner)
         
         return {
             'edge_contact': edge_contact,
@@ -736,43 +1077,57 @@ class ProximalPolicyOptimization(Policy):
             'position_quality': pos_x == 0 or pos_y == 0  # Preference for edge placement
         }
     
-    def plot_training_progress(self):
+    def plot_training_progress(self, max_points=2000):
         """Enhanced plot training metrics with episode tracking"""
-        plt.figure(figsize=(15, 10))
+        # A pyplot-free figure renders with Agg, so nothing depends on the global backend
+        if self._progress_fig is None:
+            self._progress_fig = Figure(figsize=(15, 10))
+            self._progress_fig.subplots(2, 2)
+        fig = self._progress_fig
+        ax_rewards, ax_ratios, ax_edges, ax_corners = fig.axes
+        
+        def downsample(values, start=0):
+            """Every k-th value and its index, keeping at most max_points points"""
+            stride = max(1, -(-len(values) // max_points))
+            return np.arange(start, start + len(values), stride), np.asarray(values)[::stride]
+        
+        def placement_metric(key):
+            values = self.metrics.get_metric_values(key)
+            return downsample(values, self.metrics.metric_counts[key] - len(values))
+        
+        history = self.metrics.episode_history
+        _, episodes = downsample(history['episode_numbers'])
         
         # Plot rewards
-        plt.subplot(221)
-        plt.plot(self.metrics.episode_history['episode_numbers'], 
-                 self.metrics.episode_history['episode_rewards'])
-        plt.title('Episode Rewards')
-        plt.xlabel('Episode')
-        plt.ylabel('Total Reward')
+        ax_rewards.clear()
+        ax_rewards.plot(episodes, downsample(history['episode_rewards'])[1])
+        ax_rewards.set_title('Episode Rewards')
+        ax_rewards.set_xlabel('Episode')
+        ax_rewards.set_ylabel('Total Reward')
         
         # Plot filled ratios
-        plt.subplot(222)
-        plt.plot(self.metrics.episode_history['episode_numbers'], 
-                 self.metrics.episode_history['episode_filled_ratios'])
-        plt.title('Filled Ratios')
-        plt.xlabel('Episode')
-        plt.ylabel('Ratio')
+        ax_ratios.clear()
+        ax_ratios.plot(episodes, downsample(history['episode_filled_ratios'])[1])
+        ax_ratios.set_title('Filled Ratios')
+        ax_ratios.set_xlabel('Episode')
+        ax_ratios.set_ylabel('Ratio')
         
         # Plot edge utilization
-        plt.subplot(223)
-        plt.plot(self.metrics.episode_metrics['edge_utilization'])
-        plt.title('Edge Utilization')
-        plt.xlabel('Episode')
-        plt.ylabel('Count')
+        ax_edges.clear()
+        ax_edges.plot(*placement_metric('edge_utilization'))
+        ax_edges.set_title('Edge Utilization')
+        ax_edges.set_xlabel('Episode')
+        ax_edges.set_ylabel('Count')
         
         # Plot corner placements
-        plt.subplot(224)
-        plt.plot(self.metrics.episode_metrics['corner_placements'])
-        plt.title('Corner Placements')
-        plt.xlabel('Episode')
-        plt.ylabel('Count')
-        
-        plt.tight_layout()
-        plt.savefig(os.path.join(self.model_path, 'training_progress.png'))
-        plt.close()
+        ax_corners.clear()
+        ax_corners.plot(*placement_metric('corner_placements'))
+        ax_corners.set_title('Corner Placements')
+        ax_corners.set_xlabel('Episode')
+        ax_corners.set_ylabel('Count')
+        
+        fig.tight_layout()
+        fig.savefig(os.path.join(self.model_path, 'training_progress.png'))
 
     def log_episode_summary(self, steps, filled_ratio, episode_reward, observation):
         """Enhanced log episode summary with metrics tracking"""
@@ -791,58 +1146,30 @@ class ProximalPolicyOptimization(Policy):
 
     def find_best_fitting_stock(self, observation, product_size):
         """Enhanced stock selection with better utilization balance"""
-        best_stock_idx = None
-        best_score = float('-inf')
-        product_area = product_size[0] * product_size[1]
-        
-        # Count partially filled stocks
-        partially_filled_stocks = []
-        empty_stocks = []
-        
-        for idx, stock in enumerate(observation["stocks"]):
-            stock_w, stock_h = self._get_stock_size_(stock)
-            used_area = np.sum(stock != -1)
-            
-            if used_area > 0 and used_area < stock_w * stock_h:
-                partially_filled_stocks.append(idx)
-            elif used_area == 0:
-                empty_stocks.append(idx)
-        
-        # First try partially filled stocks
-        for idx in partially_filled_stocks:
-            stock = observation["stocks"][idx]
-            stock_w, stock_h = self._get_stock_size_(stock)
-            used_area = np.sum(stock != -1)
-            utilization = used_area / (stock_w * stock_h)
-            
-            # Prefer stocks that are not too full
-            if utilization < 0.8:  # 80% threshold
-                score = 100  # Base score for partially filled stock
-                # Bonus for moderate utilization
-                score += (0.8 - utilization) * 50  # More bonus for less utilized stocks
-                
-                if score > best_score:
-                    best_score = score
-                    best_stock_idx = idx
-        
-        # If no suitable partially filled stock, try empty stocks
-        if best_stock_idx is None and empty_stocks:
-            # Pick the first empty stock
-            best_stock_idx = empty_stocks[0]
-        
-        return best_stock_idx
+        used_area = self._used_areas
+        utilization = used_area / self._stock_areas
+        
+        # First try partially filled stocks that are not too full (80% threshold),
+        # preferring the least utilized one
+        partial = (used_area > 0) & (used_area < self._stock_areas) & (utilization < 0.8)
+        if partial.any():
+            return int(np.where(partial, utilization, np.inf).argmin())
+        
+        # Otherwise pick the first empty stock
+        empty = np.flatnonzero(used_area == 0)
+        if empty.size:
+            return int(empty[0])
+        return None
 
     def _count_small_products(self, stock):
         """Count number of small products (isolated pieces) in the stock"""
-        unique_products = np.unique(stock[stock != -1])
-        small_products = 0
-        
-        for prod_id in unique_products:
-            prod_mask = stock == prod_id
-            if np.sum(prod_mask) < 20:  # Consider products smaller than 20 cells
-                small_products += 1
-            
-        return small_products
+        return self._count_small_values(stock)
+
+    def _count_small_values(self, region):
+        """Count distinct non-empty values (padding included) covering fewer than 20 cells of the region"""
+        # Shift by 2 so the padding value -2 gets a bincount slot
+        counts = np.bincount(region[region != -1].ravel() + 2)
+        return np.count_nonzero((counts > 0) & (counts < 20))
 
     def evaluate_placement_pattern(self, stock, pos_x, pos_y, size_w, size_h):
         """Enhanced pattern evaluation with better small product handling"""
@@ -868,19 +1195,17 @@ class ProximalPolicyOptimization(Policy):
             score -= distance_to_filled * 0.5
         else:
             # Logic for larger pieces
+            edge_x = bool(pos_x == 0) | bool(pos_x + size_w == stock_w)
+            edge_y = bool(pos_y == 0) | bool(pos_y + size_h == stock_h)
+            
             # 1. Edge alignment (40%)
-            if pos_x == 0 or pos_x + size_w == stock_w:
-                score += 2.0
-            if pos_y == 0 or pos_y + size_h == stock_h:
-                score += 2.0
+            score += 2.0 * edge_x + 2.0 * edge_y
             
             # 2. Corner bonus (30%)
-            if (pos_x == 0 or pos_x + size_w == stock_w) and \
-               (pos_y == 0 or pos_y + size_h == stock_h):
-                score += 3.0
+            score += 3.0 * (edge_x & edge_y)
             
             # 3. Space utilization (30%)
-            used_space = np.sum(stock != -1)
+            used_space = self._get_used_area(stock)
             total_space = stock_w * stock_h
             utilization = used_space / total_space
             score += utilization * 2.0
@@ -895,53 +1220,55 @@ class ProximalPolicyOptimization(Policy):
         y_start = max(0, pos_y - padding)
         y_end = min(stock.shape[0], pos_y + size_h + padding)
         
-        region = stock[y_start:y_end, x_start:x_end]
-        unique_products = np.unique(region[region != -1])
-        
-        small_pieces = 0
-        for prod_id in unique_products:
-            prod_mask = region == prod_id
-            if np.sum(prod_mask) < 20:
-                small_pieces += 1
-            
-        return small_pieces
+        return self._count_small_values(stock[y_start:y_end, x_start:x_end])
 
     def _get_distance_to_filled(self, stock, pos_x, pos_y):
         """Calculate Manhattan distance to nearest filled cell"""
-        filled_positions = np.where(stock != -1)
-        if len(filled_positions[0]) == 0:
-            return 0
-        
-        distances = abs(filled_positions[0] - pos_y) + abs(filled_positions[1] - pos_x)
-        return np.min(distances) if len(distances) > 0 else 0
+        if not (0 <= pos_y < stock.shape[0] and 0 <= pos_x < stock.shape[1]):
+            filled_positions = np.where(self._get_used_mask(stock))
+            if len(filled_positions[0]) == 0:
+                return 0
+            return np.min(abs(filled_positions[0] - pos_y) + abs(filled_positions[1] - pos_x))
+        return self._get_filled_distance_map(stock)[pos_y, pos_x]
+
+    def _get_filled_distance_map(self, stock):
+        """Taxicab distance from every cell to the nearest filled cell,
+        computed once per stock until it is cut again"""
+        idx = self._stock_index.get(id(stock))
+        if idx is not None and self._filled_distance[idx] is not None:
+            return self._filled_distance[idx]
+        used_mask = self._get_used_mask(stock)
+        if used_mask.any():
+            distance = distance_transform_cdt(~used_mask, metric='taxicab')
+        else:
+            distance = np.zeros(used_mask.shape, dtype=np.int32)
+        if idx is not None:
+            self._filled_distance[idx] = distance
+        return distance
 
     def _get_structured_placement(self, observation):
         """Get structured placement for initial or few remaining products"""
         # Find the largest product first
-        largest_product = None
-        largest_area = 0
-        for prod in observation["products"]:
-            if prod["quantity"] > 0:
-                area = prod["size"][0] * prod["size"][1]
-                if area > largest_area:
-                    largest_area = area
-                    largest_product = prod
+        largest_product = self._get_largest_product(observation)
         
         if not largest_product:
             return None
         
         # Try to place in the first available stock
+        prod_w, prod_h = largest_product["size"]
         for stock_idx, stock in enumerate(observation["stocks"]):
-            stock_w, stock_h = self._get_stock_size_(stock)
+            stock_w, stock_h = self._stock_sizes[stock_idx]
+            if prod_w > stock_w or prod_h > stock_h:
+                continue
             
-            # If stock is empty, try corners first
-            if np.all(stock == -1):
+            # An untouched stock fits the piece at any corner, so only those are tried
+            if not self._stock_used[stock_idx]:
                 # Try corners in this order: top-left, top-right, bottom-left, bottom-right
                 corners = [
                     (0, 0),
-                    (stock_w - largest_product["size"][0], 0),
-                    (0, stock_h - largest_product["size"][1]),
-                    (stock_w - largest_product["size"][0], stock_h - largest_product["size"][1])
+                    (stock_w - prod_w, 0),
+                    (0, stock_h - prod_h),
+                    (stock_w - prod_w, stock_h - prod_h)
                 ]
                 
                 for pos_x, pos_y in corners:
@@ -951,25 +1278,19 @@ class ProximalPolicyOptimization(Policy):
                             "size": largest_product["size"],
                             "position": (pos_x, pos_y)
                         }
+                continue
             
-            # If no corners available, try edges
-            edges = []
-            # Top edge
-            for x in range(0, stock_w - largest_product["size"][0] + 1):
-                edges.append((x, 0))
-            # Left edge
-            for y in range(0, stock_h - largest_product["size"][1] + 1):
-                edges.append((0, y))
-            # Bottom edge
-            for x in range(0, stock_w - largest_product["size"][0] + 1):
-                edges.append((x, stock_h - largest_product["size"][1]))
-            # Right edge
-            for y in range(0, stock_h - largest_product["size"][1] + 1):
-                edges.append((stock_w - largest_product["size"][0], y))
-            
-            # Try each edge position
-            for pos_x, pos_y in edges:
-                if self._can_place_(stock, (pos_x, pos_y), largest_product["size"]):
+            # Otherwise try edges: top, left, bottom, right, read off the free-window map
+            free = self._get_free_windows(self._get_filled_prefix_sum(stock), stock_w, stock_h, prod_w, prod_h)
+            last_x, last_y = stock_w - prod_w, stock_h - prod_h
+            for edge_free, edge_position in (
+                    (free[:, 0], lambda i: (i, 0)),
+                    (free[0, :], lambda i: (0, i)),
+                    (free[:, last_y], lambda i: (i, last_y)),
+                    (free[last_x, :], lambda i: (last_x, i))):
+                hits = np.flatnonzero(edge_free)
+                if len(hits) > 0:
+                    pos_x, pos_y = edge_position(int(hits[0]))
                     return {
                         "stock_idx": stock_idx,
                         "size": largest_product["size"],
@@ -979,37 +1300,29 @@ class ProximalPolicyOptimization(Policy):
         # If no structured placement is possible, return None
         return None
 
+    def _get_products_by_area(self, observation):
+        """Products with remaining quantity, largest area first"""
+        products = observation["products"]
+        return [products[i] for i in self._product_order if products[i]["quantity"] > 0]
+
     def _get_largest_product(self, observation):
         """Find the product with the largest area that still has remaining quantity"""
-        largest_product = None
-        largest_area = 0
-        
-        for product in observation["products"]:
-            if product["quantity"] > 0:  # Only consider products with remaining quantity
-                area = product["size"][0] * product["size"][1]
-                if area > largest_area:
-                    largest_area = area
-                    largest_product = product
-        
-        return largest_product
+        products = self._get_products_by_area(observation)
+        return products[0] if products else None
 
     def _get_greedy_action(self, observation):
         """Implements greedy placement strategy with enhanced rotation logic"""
         best_action = None
         best_score = float('-inf')
-        max_attempts = 1000
-        attempts = 0
-        
-        # Sort products by area (largest first)
-        products = sorted(
-            [prod for prod in observation["products"] if prod["quantity"] > 0],
-            key=lambda x: x["size"][0] * x["size"][1],
-            reverse=True
-        )
+        
+        # Products by area (largest first)
+        products = self._get_products_by_area(observation)
         
         if not products:
             return None
         
+        used_area = self._used_areas
+        
         # Try each product
         for prod in products:
             # Always try both orientations for each product
@@ -1021,45 +1334,70 @@ class ProximalPolicyOptimization(Policy):
             for prod_size in orientations:
                 prod_w, prod_h = prod_size
                 
+                # Untouched stocks of the same size score identically, so only the first is tried
+                seen_empty = set()
+                
                 # Try each stock
+                rotated = prod_size != list(prod["size"])
+                
                 for stock_idx, stock in enumerate(observation["stocks"]):
-                    if attempts >= max_attempts:
-                        return best_action if best_action is not None else None
-                        
-                    stock_w, stock_h = self._get_stock_size_(stock)
+                    stock_w, stock_h = self._stock_sizes[stock_idx]
                     
                     # Skip if product can't fit in either orientation
                     if stock_w < prod_w or stock_h < prod_h:
                         continue
                     
-                    # Try placement at each position
-                    for y in range(stock_h - prod_h + 1):
-                        for x in range(stock_w - prod_w + 1):
-                            attempts += 1
-                            if attempts >= max_attempts:
-                                return best_action if best_action is not None else None
-                                
-                            if self._can_place_(stock, (x, y), prod_size):
-                                score = self._calculate_placement_score(
-                                    stock, x, y, prod_w, prod_h, stock_w, stock_h
-                                )
-                                
-                                # Give small bonus for rotated placement if it improves utilization
-                                if prod_size != list(prod["size"]):
-                                    if score > 0:  # Only boost positive scores
-                                        score *= 1.05
-                                
-                                if score > best_score:
-                                    best_score = score
-                                    best_action = {
-                                        "stock_idx": stock_idx,
-                                        "size": prod_size,
-                                        "position": (x, y)
-                                    }
+                    # Lowest unboosted score that could still beat the best one
+                    score_floor = min(best_score, best_score / 1.05) if rotated else best_score
+                    stock_utilization = used_area[stock_idx] / (stock_w * stock_h)
+                    
+                    # Placements on an untouched stock score at most 10
+                    if stock_utilization == 0 and score_floor >= 10:
+                        continue
+                    
+                    if not self._stock_used[stock_idx]:
+                        if (stock_w, stock_h) in seen_empty:
+                            continue
+                        seen_empty.add((stock_w, stock_h))
+                    
+                    # Only bottom-left positions on the skyline are candidates, in row-by-row order
+                    positions = self._get_skyline_positions(
+                        self._get_filled_prefix_sum(stock), stock_w, stock_h, prod_w, prod_h)
+                    
+                    for y, x in np.argwhere(positions.T).tolist():
+                        # Penalties only lower the score, so they are skipped when the bonus cannot win
+                        score = self._calculate_placement_bonus(
+                            stock, x, y, prod_w, prod_h, stock_w, stock_h, stock_utilization
+                        )
+                        if score <= score_floor:
+                            continue
+                        score = self._subtract_placement_penalties(score, stock, x, y, prod_w, prod_h)
+                        
+                        # Give small bonus for rotated placement if it improves utilization
+                        if rotated:
+                            if score > 0:  # Only boost positive scores
+                                score *= 1.05
+                        
+                        if score > best_score:
+                            best_score = score
+                            score_floor = min(best_score, best_score / 1.05) if rotated else best_score
+                            best_action = {
+                                "stock_idx": stock_idx,
+                                "size": prod_size,
+                                "position": (x, y)
+                            }
 
         return best_action
 
-    def _calculate_placement_score(self, stock, pos_x, pos_y, prod_w, prod_h, stock_w, stock_h):
+    def _calculate_placement_score(self, stock, pos_x, pos_y, prod_w, prod_h, stock_w, stock_h,
+                                   stock_utilization=None):
+        score = self._calculate_placement_bonus(
+            stock, pos_x, pos_y, prod_w, prod_h, stock_w, stock_h, stock_utilization)
+        return self._subtract_placement_penalties(score, stock, pos_x, pos_y, prod_w, prod_h)
+
+    def _calculate_placement_bonus(self, stock, pos_x, pos_y, prod_w, prod_h, stock_w, stock_h,
+                                   stock_utilization=None):
+        """Positive part of the placement score, an upper bound on the full score"""
         score = 0
         
         # Calculate center coordinates
@@ -1070,7 +1408,8 @@ class ProximalPolicyOptimization(Policy):
         dist_to_center = abs(pos_x + prod_w/2 - center_x) + abs(pos_y + prod_h/2 - center_y)
         
         # First check if stock is already in use
-        stock_utilization = np.sum(stock != -1) / (stock_w * stock_h)
+        if stock_utilization is None:
+            stock_utilization = self._get_used_area(stock) / (stock_w * stock_h)
         
         if stock_utilization > 0:
             # Priority 1: Complete partially filled stocks
@@ -1108,6 +1447,10 @@ class ProximalPolicyOptimization(Policy):
                 elif pos_x == 0 or pos_x + prod_w == stock_w or pos_y == 0 or pos_y + prod_h == stock_h:
                     score += 5   # Reduced from 10
         
+        return score
+
+    def _subtract_placement_penalties(self, score, stock, pos_x, pos_y, prod_w, prod_h):
+        """Apply the waste penalties of a placement to its bonus score"""
         # Increased penalties for waste creation
         gaps_above = self._count_gaps_above(stock, pos_x, pos_y, prod_w)
         score -= gaps_above * 15  # Increased penalty
@@ -1124,58 +1467,56 @@ class ProximalPolicyOptimization(Policy):
 
     def _is_perfect_fit(self, stock, pos_x, pos_y, prod_w, prod_h):
         """Enhanced perfect fit detection with better alignment checking"""
-        directions = [(0, 1), (0, -1), (1, 0), (-1, 0)]
+        used = self._get_used_mask(stock)
+        height, width = used.shape
         perfect_fits = 0
-        alignment_quality = 0
         
-        for dx, dy in directions:
-            check_x = pos_x + dx * prod_w
-            check_y = pos_y + dy * prod_h
-            
-            if (0 <= check_x < stock.shape[1] and 
-                0 <= check_y < stock.shape[0]):
-                # Check for full side alignment
-                if dx != 0:  # Horizontal alignment
-                    aligned_cells = sum(1 for y in range(pos_y, pos_y + prod_h)
-                                     if 0 <= check_x < stock.shape[1] and
-                                     stock[y, check_x] != -1)
-                    if aligned_cells == prod_h:
-                        perfect_fits += 1
-                        alignment_quality += aligned_cells / prod_h
-                
-                elif dy != 0:  # Vertical alignment
-                    aligned_cells = sum(1 for x in range(pos_x, pos_x + prod_w)
-                                     if 0 <= check_y < stock.shape[0] and
-                                     stock[check_y, x] != -1)
-                    if aligned_cells == prod_w:
-                        perfect_fits += 1
-                        alignment_quality += aligned_cells / prod_w
-        
-        return perfect_fits >= 2 or alignment_quality >= 1.5  # More flexible perfect fit criteria
+        # Horizontal alignment: the full column one piece-width to either side is filled
+        if 0 <= pos_y < height:
+            for check_x in (pos_x + prod_w, pos_x - prod_w):
+                if 0 <= check_x < width:
+                    perfect_fits += np.count_nonzero(used[pos_y:pos_y + prod_h, check_x]) == prod_h
+        
+        # Vertical alignment: the full row one piece-height above or below is filled
+        if 0 <= pos_x < width:
+            for check_y in (pos_y + prod_h, pos_y - prod_h):
+                if 0 <= check_y < height:
+                    perfect_fits += np.count_nonzero(used[check_y, pos_x:pos_x + prod_w]) == prod_w
+        
+        # Each full side adds 1 to the alignment quality, so both criteria need two sides
+        return perfect_fits >= 2
 
     def _calculate_small_gap_penalty(self, stock, pos_x, pos_y, prod_w, prod_h):
         """Calculate penalty for creating small gaps between pieces"""
-        penalty = 0
         padding = 2  # Check 2 cells around the placement
         
-        for dx in range(-padding, prod_w + padding):
-            for dy in range(-padding, prod_h + padding):
-                check_x = pos_x + dx
-                check_y = pos_y + dy
-                
-                if (0 <= check_x < stock.shape[1] and 
-                    0 <= check_y < stock.shape[0]):
-                    # Check if this creates a small gap
-                    if stock[check_y, check_x] == -1:
-                        gap_size = self._get_empty_area_size(stock, check_x, check_y)
-                        if 0 < gap_size < 4:  # Penalize very small gaps
-                            penalty += 1
-        
-        return penalty
+        # Every empty cell within the padded window that belongs to a very small gap
+        region = self._clip_region(self._get_small_gap_cells(stock), pos_x - padding, pos_y - padding,
+                                   pos_x + prod_w + padding, pos_y + prod_h + padding)
+        return np.count_nonzero(region)
+
+    def _get_small_gap_cells(self, stock):
+        """Mask of empty cells whose connected empty area has fewer than 4 cells"""
+        return self._get_empty_components(stock)[2]
+
+    def _get_empty_components(self, stock):
+        """Connected empty areas of a stock as (labels, size per label, small-gap mask),
+        labelled once per stock until it is cut again"""
+        idx = self._stock_index.get(id(stock))
+        if idx is not None and self._empty_components[idx] is not None:
+            return self._empty_components[idx]
+        labels, _ = label(~self._get_used_mask(stock))
+        sizes = np.bincount(labels.ravel())
+        sizes[0] = 0  # Label 0 is the filled cells
+        components = (labels, sizes, ((sizes > 0) & (sizes < 4))[labels])
+        if idx is not None:
+            self._empty_components[idx] = components
+        return components
 
     def _calculate_isolation_penalty(self, stock, pos_x, pos_y, prod_w, prod_h):
         """Calculate penalty for creating small isolated areas"""
         stock_w, stock_h = self._get_stock_size_(stock)
+        labels, sizes, _ = self._get_empty_components(stock)
         penalty = 0
         
         # Check surrounding areas for potential isolation
@@ -1186,84 +1527,32 @@ class ProximalPolicyOptimization(Policy):
             
             # Check if the adjacent area would become isolated
             if (0 <= check_x < stock_w and 0 <= check_y < stock_h):
-                area_size = self._get_empty_area_size(stock, check_x, check_y)
+                area_size = sizes[labels[check_y, check_x]]
                 if 0 < area_size < prod_w * prod_h:  # If area is smaller than current piece
                     penalty += 1
         
         return penalty
 
-    def _get_empty_area_size(self, stock, start_x, start_y):
-        """Calculate size of connected empty area starting from given position"""
-        if start_x < 0 or start_y < 0 or start_x >= stock.shape[1] or start_y >= stock.shape[0]:
-            return 0
-        if stock[start_y, start_x] != -1:
-            return 0
-        
-        visited = set()
-        stack = [(start_x, start_y)]
-        area = 0
-        
-        while stack:
-            x, y = stack.pop()
-            if (x, y) in visited:
-                continue
-            
-            visited.add((x, y))
-            area += 1
-            
-            for dx, dy in [(-1, 0), (1, 0), (0, -1), (0, 1)]:
-                new_x, new_y = x + dx, y + dy
-                if (0 <= new_x < stock.shape[1] and 0 <= new_y < stock.shape[0] and 
-                    stock[new_y, new_x] == -1 and (new_x, new_y) not in visited):
-                    stack.append((new_x, new_y))
-    
-        return area
-
     def _count_gaps_above(self, stock, pos_x, pos_y, width):
         """Count empty cells above the placement position"""
-        gaps = 0
-        for x in range(pos_x, pos_x + width):
-            for y in range(0, pos_y):
-                if stock[y, x] == -1:
-                    gaps += 1
-        return gaps
+        return self._count_empty_in_region(stock, pos_x, 0, pos_x + width, pos_y)
 
     def _count_empty_neighbors(self, stock, pos_x, pos_y, size_w, size_h):
         """Count empty neighboring cells around the placement"""
-        empty_count = 0
-        padding = 1
-        
-        for dx in range(-padding, size_w + padding):
-            for dy in range(-padding, size_h + padding):
-                check_x = pos_x + dx
-                check_y = pos_y + dy
-                
-                # Skip the cells where the piece will be placed
-                if 0 <= dx < size_w and 0 <= dy < size_h:
-                    continue
-                    
-                # Check if position is within bounds
-                if (0 <= check_x < stock.shape[1] and 
-                    0 <= check_y < stock.shape[0]):
-                    if stock[check_y, check_x] == -1:
-                        empty_count += 1
-    
-        return empty_count
+        return sum(
+            self._count_empty_in_region(stock, *border)
+            for border in self._get_border_regions(pos_x, pos_y, size_w, size_h)
+        )
 
     def calculate_filled_ratio(self, observation):
         """Calculate the correct filled ratio based only on used stocks"""
-        total_used_area = 0
-        total_stock_area = 0
-        
-        for stock in observation['stocks']:
-            # Check if stock is used (has any non-negative values)
-            if np.any(stock != -1):
-                stock_w, stock_h = self._get_stock_size_(stock)
-                stock_area = stock_w * stock_h
-                used_area = np.sum(stock != -1)  # Count non-empty cells
-                
-                total_used_area += used_area
-                total_stock_area += stock_area
+        self._sync_episode(observation)
+        
+        # Stocks count as used when they have any non-empty cell
+        used_area = self._used_areas
+        used = used_area > 0
+        total_used_area = used_area[used].sum()
+        total_stock_area = self._stock_areas[used].sum()
         
         # Calculate ratio only if we have used stocks
         if total_stock_area > 0:
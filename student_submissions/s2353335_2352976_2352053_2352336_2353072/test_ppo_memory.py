@@ -0,0 +1,51 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import torch
+from ProximalPolicyOptimization import PPOMemory
+
+
+def _add(memory, step):
+    state = torch.full((4,), float(step))
+    valid_actions = torch.ones(6, dtype=torch.bool)
+    return memory.add(state, step, step, 0.0, -1.0, False, valid_actions)
+
+
+def test_add_past_capacity_drops_transition():
+    memory = PPOMemory(3, "cpu")
+    assert all(_add(memory, step) for step in range(3))
+    assert memory.is_full()
+
+    # Adds past capacity are dropped instead of indexing out of bounds
+    assert not _add(memory, 3)
+    assert not _add(memory, 4)
+    assert len(memory) == 3
+    assert memory.actions.tolist() == [0, 1, 2]
+    assert memory.states[:, 0].tolist() == [0.0, 1.0, 2.0]
+
+    # A reward for a dropped transition must not land on the last stored one
+    memory.update_last(10.0, True)
+    assert memory.rewards.tolist() == [0.0, 1.0, 2.0]
+    assert memory.dones.tolist() == [0.0, 0.0, 0.0]
+
+
+def test_clear_makes_room_again():
+    memory = PPOMemory(2, "cpu")
+    _add(memory, 0)
+    _add(memory, 1)
+    assert not _add(memory, 2)
+
+    memory.clear()
+    assert _add(memory, 5)
+    memory.update_last(7.0, True)
+    assert len(memory) == 1
+    assert memory.actions[0].item() == 5
+    assert memory.rewards[0].item() == 7.0
+    assert memory.dones[0].item() == 1.0
+
+
+if __name__ == "__main__":
+    test_add_past_capacity_drops_transition()
+    test_clear_makes_room_again()
+    print("ok")
@@ -86,6 +86,10 @@ def train_policy(env, policy, num_episodes=100):
                     if ep > 0 and ep % 10 == 0:
                         log_info(f"\nSaving model at episode {ep}...")
                         if isinstance(policy, ProximalPolicyOptimization):
+                            metrics = policy.metrics
+                            log_info(f"Running average over the last {metrics.running_window} episodes - "
+                                     f"Filled ratio: {metrics.get_running_average('filled_ratio'):.3f}, "
+                                     f"Reward: {metrics.get_running_average('reward'):.2f}")
                             policy.save_model("model_ppo_best")
                         elif isinstance(policy, ActorCriticPolicy2):
                             policy.save_model("model_a2c_best")